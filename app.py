@@ -1,74 +1,523 @@
 from flask import Flask, request
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
-from datetime import datetime, timedelta
+from gspread.utils import absolute_range_name, fill_gaps, rowcol_to_a1
+from datetime import date, datetime, time as dtime, timedelta
 import time
-from threading import Thread
+import atexit
+import heapq
+from functools import wraps
+from bisect import bisect_right
+from collections import Counter, namedtuple
+from operator import itemgetter
+from queue import Queue, Empty
+from threading import Condition, Thread, Lock
 import os
+from sheets import LazyWorksheet, get_spreadsheet, with_backoff
 
 app = Flask(__name__)
 
-# === Google Sheet Setup ===
-SERVICE_ACCOUNT_FILE = "/etc/secrets/credentials.json"
-scope = [
-    'https://spreadsheets.google.com/feeds',
-    'https://www.googleapis.com/auth/drive'
-]
-client = gspread.service_account(filename=SERVICE_ACCOUNT_FILE)
-spreadsheet = client.open("StudyPlusData")
-
-# Define separate sheets
-attendance_sheet = spreadsheet.worksheet("attendance")
-session_sheet = spreadsheet.worksheet("session") 
-task_sheet = spreadsheet.worksheet("task")
-xp_sheet = spreadsheet.worksheet("xp")
-
-# Add goal sheet - make sure this sheet exists in your Google Sheet
-# Sheet should have columns: Username, UserID, GoalName, CreatedDate, CompletedDate, Status
-try:
-    goal_sheet = spreadsheet.worksheet("goal")
-except:
-    # If goal sheet doesn't exist, create it
-    goal_sheet = spreadsheet.add_worksheet(title="goal", rows="1000", cols="6")
-    goal_sheet.append_row(["Username", "UserID", "GoalName", "CreatedDate", "CompletedDate", "Status"])
+# Define separate sheets (opened on first use, see sheets.py)
+attendance_sheet = LazyWorksheet("attendance")
+session_sheet = LazyWorksheet("session")
+task_sheet = LazyWorksheet("task")
+xp_sheet = LazyWorksheet("xp")
+# Columns: Username, UserID, GoalName, CreatedDate, CompletedDate, Status
+# (created by bootstrap.py if missing)
+goal_sheet = LazyWorksheet("goal")
+ALL_SHEETS = (attendance_sheet, session_sheet, task_sheet, xp_sheet, goal_sheet)
+
+# === Sheet Cache ===
+# Every read of a worksheet is a full download, so its records are kept in
+# memory and a background thread refetches them every CACHE_TTL seconds.
+# Writes update the cached records in place (see the background writer
+# below) so reads see them before they reach the sheet.
+CACHE_TTL = 15  # seconds
+# Requests only fetch inline on a cold start or if the refresher fell this far behind
+CACHE_MAX_AGE = 120  # seconds
+# Numbers come back as numbers instead of display strings, while date cells
+# stay formatted strings so the timestamp parsing below still applies
+VALUE_RENDER_OPTION = "UNFORMATTED_VALUE"
+DATE_TIME_RENDER_OPTION = "FORMATTED_STRING"
+sheet_cache = {}  # worksheet id -> CacheEntry
+write_versions = {}  # worksheet id -> number of writes queued so far
+cache_lock = Lock()
+flushed_versions = {}  # worksheet id -> version of the last write the writer is done with
+flushed_cond = Condition(cache_lock)  # notified whenever flushed_versions moves
+
+# headers are kept so appends to a sheet without records can still be cached
+CacheEntry = namedtuple("CacheEntry", ["records", "index", "headers", "fetched_at"])
+
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def _fast_parse_date(s):
+    """Parse the date of a "YYYY-MM-DD HH:MM:SS" string by slicing instead of strptime"""
+    if len(s) < 10 or s[4] != '-' or s[7] != '-':
+        # Not fixed-width (e.g. "2025-1-01 9:05:00"); strptime still accepts those
+        return datetime.strptime(s, TIMESTAMP_FORMAT).date()
+    return date(int(s[0:4]), int(s[5:7]), int(s[8:10]))
+
+
+def _fast_parse_dt(s):
+    """Parse a "YYYY-MM-DD HH:MM:SS" string by slicing instead of strptime"""
+    if len(s) != 19 or s[10] != ' ' or s[13] != ':' or s[16] != ':':
+        # Not fixed-width (e.g. "2025-01-01 9:05:00"); strptime still accepts those
+        return datetime.strptime(s, TIMESTAMP_FORMAT)
+    return datetime.combine(_fast_parse_date(s), dtime(int(s[11:13]), int(s[14:16]), int(s[17:19])))
+
+
+def _try_parse(parse, value):
+    try:
+        return parse(str(value))
+    except ValueError:
+        return None
+
+
+def _to_int(value):
+    """int() for numeric cells, 0 for blank or junk ones, without raising"""
+    # UNFORMATTED_VALUE hands back numbers as int/float already, so the
+    # string branch only sees hand-edited cells
+    if isinstance(value, int):
+        return value
+    if isinstance(value, float):
+        return int(value)
+    if isinstance(value, str):
+        value = value.strip()
+        # One optional sign, then decimal digits only: isdigit() would also
+        # pass '²', and lstrip('-') would pass '--5', both of which int() rejects
+        digits = value[1:] if value[:1] in ('-', '+') else value
+        if digits.isdecimal():
+            return int(value)
+    return 0
+
+
+def _normalize(row):
+    """Coerce the columns that routes compare or add up, once per cached record"""
+    if 'UserID' in row:
+        row['UserID'] = str(row['UserID'])
+    if 'Status' in row:
+        row['Status'] = str(row['Status']).strip()
+    for col in ('TotalXP', 'Duration'):
+        if col in row:
+            row[col] = _to_int(row[col])
+    # Timestamps are parsed here once rather than in every route that reads
+    # them; None means blank or malformed
+    if 'Date' in row:
+        row['_day'] = _try_parse(_fast_parse_date, row['Date'])  # attendance day
+    if 'StartTime' in row:
+        row['_start'] = _try_parse(_fast_parse_dt, row['StartTime'])
+    if 'LastUpdated' in row:
+        row['_updated'] = _try_parse(_fast_parse_dt, row['LastUpdated'])
+    return row
+
+
+def _build_index(records):
+    """Index records by UserID as (row_number, record) pairs"""
+    index = {}
+    for i, row in enumerate(records):
+        index.setdefault(row.get('UserID', ''), []).append((i + 2, row))
+    return index
+
+
+def _is_fresh(entry, ttl):
+    return entry is not None and time.time() - entry.fetched_at < ttl
+
+
+def _store_values(sheet, values, version):
+    """Cache a worksheet's values unless it was written to after `version`"""
+    # Dicts like get_all_records() builds, but the header row survives an empty sheet
+    headers = values[0] if values else []
+    records = [_normalize(dict(zip(headers, row))) for row in values[1:]]
+    entry = CacheEntry(records, _build_index(records), headers, time.time())
+    with cache_lock:
+        if write_versions.get(sheet.id, 0) == version:
+            sheet_cache[sheet.id] = entry
+    return entry
+
+
+def _cache_entry(sheet, ttl):
+    # A dict lookup is atomic, so cache hits skip the lock; only writers and
+    # fetches take it
+    entry = sheet_cache.get(sheet.id)
+    if _is_fresh(entry, ttl):
+        return entry
+
+    # Load every other stale sheet in the same call (on a cold start that's
+    # all of them), so the next requests don't each pay a round-trip
+    fetched = prefetch(*ALL_SHEETS, ttl=ttl)
+    return fetched.get(sheet.id) or sheet_cache[sheet.id]
+
+
+def prefetch(*sheets, ttl=CACHE_MAX_AGE):
+    """Fetch all stale worksheets in a single values_batch_get call; returns {worksheet id: CacheEntry}"""
+    stale = [sheet for sheet in sheets if not _is_fresh(sheet_cache.get(sheet.id), ttl)]
+    if not stale:
+        return {}
+
+    with cache_lock:
+        versions = [write_versions.get(sheet.id, 0) for sheet in stale]
+    # Let the writes queued so far land first so the fetch sees them; any
+    # queued after this point make _store_values discard the fetch anyway
+    wait_for_writes({sheet.id: version for sheet, version in zip(stale, versions)})
+    result = with_backoff(lambda: get_spreadsheet().values_batch_get(
+        [absolute_range_name(sheet.title) for sheet in stale],
+        params={"valueRenderOption": VALUE_RENDER_OPTION, "dateTimeRenderOption": DATE_TIME_RENDER_OPTION}
+    ))
+    fetched = {}
+    for sheet, version, value_range in zip(stale, versions, result['valueRanges']):
+        values = value_range.get('values', [])
+        fetched[sheet.id] = _store_values(sheet, fill_gaps(values) if values else [], version)
+    return fetched
+
+
+def wait_for_writes(versions, timeout=None):
+    """Block until the writer is done with each worksheet's writes up to
+    {worksheet id: version}; returns False if the timeout ran out first"""
+    with flushed_cond:
+        return flushed_cond.wait_for(
+            lambda: all(flushed_versions.get(sheet_id, 0) >= version for sheet_id, version in versions.items()),
+            timeout
+        )
+
+
+def cache_refresh_loop():
+    """Refetch every worksheet off the request path, in one call per CACHE_TTL"""
+    while True:
+        time.sleep(CACHE_TTL)
+        try:
+            prefetch(*ALL_SHEETS, ttl=0)
+        except Exception as e:
+            print(f"Error refreshing sheet cache: {e}")
+
+
+def rows_for(sheet, userid, ttl=CACHE_MAX_AGE):
+    """Return a user's (row_number, record) pairs in sheet order"""
+    return _cache_entry(sheet, ttl).index.get(str(userid), [])
+
+
+def latest_row(sheet, userid, status):
+    """Return the (row_number, record) of a user's newest row with this Status, or None"""
+    return next(((n, row) for n, row in reversed(rows_for(sheet, userid)) if row.get('Status') == status), None)
+
+
+derived_cache = {}  # (worksheet id, name) -> (CacheEntry, write version, value)
+
+
+def derived(sheet, name, compute, ttl=CACHE_MAX_AGE):
+    """Return compute(records), reusing the result until the worksheet is refetched or written to"""
+    entry = _cache_entry(sheet, ttl)
+    version = write_versions.get(sheet.id, 0)
+    memo = derived_cache.get((sheet.id, name))
+    if memo and memo[0] is entry and memo[1] == version:
+        return memo[2]
+
+    value = compute(entry.records)
+    derived_cache[(sheet.id, name)] = (entry, version, value)
+    return value
+
+
+# === Background Writer ===
+# Sheets writes take seconds, so routes queue them and return right away.
+# Each write is applied to the cached records first; if the sheet isn't
+# cached (or the row is unknown) the entry is dropped instead.
+write_queue = Queue()
+# worksheet id -> write version of the last write queued before an append or
+# delete to it failed; updates and deletes up to there were numbered against
+# rows that never moved, so they're dropped (appends don't depend on it)
+failed_versions = {}
+
+
+def _queue_write(sheet, op, payload):
+    # Called with cache_lock held so the queue order matches the cache order
+    write_versions[sheet.id] = write_versions.get(sheet.id, 0) + 1
+    write_queue.put((sheet, op, payload, write_versions[sheet.id]))
+
+
+def append_row(sheet, values):
+    """Queue a row append and add it to the cached records"""
+    with cache_lock:
+        entry = sheet_cache.get(sheet.id)
+        if entry and entry.headers:
+            row = dict.fromkeys(entry.headers, "")
+            row.update(zip(entry.headers, values))
+            _normalize(row)
+            entry.records.append(row)
+            entry.index.setdefault(row.get('UserID', ''), []).append((len(entry.records) + 1, row))
+        else:
+            sheet_cache.pop(sheet.id, None)
+        _queue_write(sheet, "append", values)
+
+
+def update_cells(sheet, row, values):
+    """Queue an update of several cells of one row ({col: value}) and apply it to the cache"""
+    with cache_lock:
+        entry = sheet_cache.get(sheet.id)
+        if entry and 0 <= row - 2 < len(entry.records) and max(values) <= len(entry.headers):
+            record = entry.records[row - 2]
+            for col, value in values.items():
+                record[entry.headers[col - 1]] = value
+            _normalize(record)
+        else:
+            sheet_cache.pop(sheet.id, None)
+        _queue_write(sheet, "update", [(rowcol_to_a1(row, col), value) for col, value in values.items()])
+
+
+def delete_rows(sheet, row):
+    """Queue a row deletion and remove it from the cached records"""
+    with cache_lock:
+        entry = sheet_cache.get(sheet.id)
+        if entry and 0 <= row - 2 < len(entry.records):
+            del entry.records[row - 2]
+            # Rows below the deleted one move up, so renumber the index
+            sheet_cache[sheet.id] = entry._replace(index=_build_index(entry.records))
+        else:
+            sheet_cache.pop(sheet.id, None)
+        _queue_write(sheet, "delete", row)
+
+
+def _delete_ranges(rows):
+    """Merge sequential row deletions into 0-based [start, end) ranges"""
+    # Each row number was taken after the deletions before it, so deleting
+    # row n twice means rows n and n+1, and n then n-1 means n-1 and n
+    ranges = []
+    for row in rows:
+        start = row - 1
+        if ranges and start == ranges[-1][0]:
+            ranges[-1] = (start, ranges[-1][1] + 1)
+        elif ranges and start == ranges[-1][0] - 1:
+            ranges[-1] = (start, ranges[-1][1])
+        else:
+            ranges.append((start, start + 1))
+    return ranges
+
+
+def _fail_write(sheet, op, payloads, error):
+    """Log a write that couldn't be sent and drop the sheet's cache so it's refetched"""
+    print(f"Error writing to {sheet.title}, lost {op} {payloads}: {error}")
+    with cache_lock:
+        sheet_cache.pop(sheet.id, None)
+        if op != "update":
+            failed_versions[sheet.id] = write_versions.get(sheet.id, 0)
+
+
+def _drop_write(sheet, op, payloads):
+    print(f"Dropped {op} {payloads} to {sheet.title}: its row numbers assumed a failed write")
+
+
+def _flush_round(runs):
+    """Send one run of writes per sheet: all cell updates in one values_batch_update,
+    all row deletions in one batch_update, and one append_rows per sheet;
+    returns {worksheet id: op} for the writes that failed"""
+    updates = [run for run in runs if run[1] == "update"]
+    deletes = [run for run in runs if run[1] == "delete"]
+    appends = [run for run in runs if run[1] == "append"]
+    calls = []  # ([run, ...] sent by the call, call, retry_server_errors)
+
+    if updates:
+        data = []
+        for sheet, _, payloads in updates:
+            # Later writes to the same cell win
+            cells = dict(cell for payload in payloads for cell in payload)
+            data += [{"range": absolute_range_name(sheet.title, a1), "values": [[value]]} for a1, value in cells.items()]
+        body = {"valueInputOption": "USER_ENTERED", "data": data}
+        calls.append((updates, lambda: get_spreadsheet().values_batch_update(body), True))
+
+    if deletes:
+        delete_requests = [
+            {"deleteDimension": {"range": {"sheetId": sheet.id, "dimension": "ROWS", "startIndex": start, "endIndex": end}}}
+            for sheet, _, rows in deletes for start, end in _delete_ranges(rows)
+        ]
+        # Resending a delete that did go through would remove the next row too
+        calls.append((deletes, lambda: get_spreadsheet().batch_update({"requests": delete_requests}), False))
+
+    for run in appends:
+        sheet, _, rows = run
+        calls.append(([run], lambda sheet=sheet, rows=rows: sheet.append_rows(rows), True))
+
+    failed = {}
+    for call_runs, call, retry_server_errors in calls:
+        try:
+            with_backoff(call, retry_server_errors)
+        except Exception as e:
+            for sheet, op, payloads in call_runs:
+                _fail_write(sheet, op, payloads, e)
+                failed[sheet.id] = op
+    return failed
+
+
+def _flush_batch(batch):
+    """Send a drained batch of queued writes, skipping those made stale by a failed write"""
+    # Writes to different sheets don't affect each other, so only each
+    # sheet's own order is kept: split it into runs of the same kind and
+    # send the next run of every sheet together
+    runs = {}  # worksheet id -> [(sheet, op, [payload, ...]), ...]
+    for sheet, op, payload, version in batch:
+        if op != "append" and version <= failed_versions.get(sheet.id, 0):
+            _drop_write(sheet, op, [payload])
+            continue
+        sheet_runs = runs.setdefault(sheet.id, [])
+        if sheet_runs and sheet_runs[-1][1] == op:
+            sheet_runs[-1][2].append(payload)
+        else:
+            sheet_runs.append((sheet, op, [payload]))
+
+    while runs:
+        failed = _flush_round([sheet_runs.pop(0) for sheet_runs in runs.values()])
+        for sheet_id, op in failed.items():
+            if op == "update":
+                continue  # rows didn't move, so later writes still line up
+            # The rest of the sheet's updates/deletes were numbered against rows
+            # the failed append/delete would have added or removed
+            for sheet, later_op, payloads in runs[sheet_id]:
+                if later_op != "append":
+                    _drop_write(sheet, later_op, payloads)
+            runs[sheet_id] = [run for run in runs[sheet_id] if run[1] == "append"]
+        runs = {sheet_id: sheet_runs for sheet_id, sheet_runs in runs.items() if sheet_runs}
+
+
+def writer_loop():
+    """Drain the write queue and send it with as few API calls as possible"""
+    while True:
+        batch = [write_queue.get()]
+        while True:
+            try:
+                batch.append(write_queue.get_nowait())
+            except Empty:
+                break
+
+        # prefetch() waits for these versions, so they must be marked done
+        # even if something below raises
+        try:
+            _flush_batch(batch)
+        except Exception as e:
+            # Unknown how much was sent, so treat every sheet as if a row write failed
+            for sheet in {sheet.id: sheet for sheet, *_ in batch}.values():
+                _fail_write(sheet, "queued", "writes", e)
+        finally:
+            with flushed_cond:
+                for sheet, _, _, version in batch:
+                    flushed_versions[sheet.id] = max(flushed_versions.get(sheet.id, 0), version)
+                flushed_cond.notify_all()
+
+
+Thread(target=writer_loop, daemon=True).start()
+Thread(target=cache_refresh_loop, daemon=True).start()
+
+
+# === Sheet Locks ===
+# Routes read a sheet, decide, then write to it (e.g. "no active session yet,
+# so start one"). One lock per worksheet keeps two requests from interleaving
+# those steps and double-writing or updating a row that just moved.
+sheet_locks = {sheet.title: Lock() for sheet in ALL_SHEETS}
+
+
+def with_sheet_lock(sheet):
+    """Run a route while holding the lock of the worksheet it reads and writes"""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            with sheet_locks[sheet.title]:
+                return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
 
 # === Helper Functions ===
+# XP is added to pending_xp and written to the xp sheet in one go every few
+# seconds, so a burst of !attend/!stop/!done costs one write per user
+XP_FLUSH_INTERVAL = 5  # seconds
+pending_xp = {}  # userid -> (username, xp not yet written)
+flushing_xp = {}  # userid -> (username, xp) taken by the running flush, not yet written
+xp_lock = Lock()  # guards the two dicts only; never held across a sheet read
+xp_flush_lock = Lock()  # one flush at a time, so a new user isn't appended twice
+
+
 def update_user_xp(username, userid, xp_earned, action_type):
-    """Update or create user XP record in the xp sheet"""
-    try:
-        records = xp_sheet.get_all_records()
-        user_found = False
-        
-        for i, row in enumerate(records):
-            if str(row['UserID']) == str(userid):
-                # Update existing user
-                current_xp = int(row.get('TotalXP', 0))
-                new_total = current_xp + int(xp_earned)
-                xp_sheet.update_cell(i + 2, 3, new_total)  # TotalXP column
-                xp_sheet.update_cell(i + 2, 4, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))  # LastUpdated
-                user_found = True
+    """Add XP to a user; it reaches the xp sheet on the next flush"""
+    with xp_lock:
+        _, delta = pending_xp.get(str(userid), (username, 0))
+        pending_xp[str(userid)] = (username, delta + int(xp_earned))
+
+
+def flush_xp():
+    """Write all pending XP to the xp sheet"""
+    with xp_flush_lock:
+        with xp_lock:
+            flushing_xp.update(pending_xp)
+            pending_xp.clear()
+
+        for userid, (username, delta) in list(flushing_xp.items()):
+            try:
+                # May fetch the sheet, so it runs outside xp_lock
+                user_rows = rows_for(xp_sheet, userid)
+            except Exception as e:
+                # Keep the rest pending and retry on the next flush
+                print(f"Error updating XP: {e}")
                 break
-        
-        if not user_found:
-            # Add new user
-            xp_sheet.append_row([
-                username,
-                userid,
-                int(xp_earned),
-                datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            ])
-    except Exception as e:
-        print(f"Error updating XP: {e}")
+            now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+            # Applying the write to the cache and leaving flushing_xp happen
+            # together, so get_user_total_xp never counts the delta twice
+            with xp_lock:
+                if user_rows:
+                    # Update existing user
+                    row_number, row = user_rows[0]
+                    new_total = row.get('TotalXP', 0) + delta
+                    update_cells(xp_sheet, row_number, {
+                        3: new_total,  # TotalXP
+                        4: now  # LastUpdated
+                    })
+                else:
+                    # Add new user
+                    append_row(xp_sheet, [username, userid, delta, now])
+                del flushing_xp[userid]
+
+        with xp_lock:
+            for userid, (username, delta) in flushing_xp.items():
+                _, newer = pending_xp.get(userid, (username, 0))
+                pending_xp[userid] = (username, delta + newer)
+            flushing_xp.clear()
+
+
+def xp_flush_loop():
+    while True:
+        time.sleep(XP_FLUSH_INTERVAL)
+        flush_xp()
+
+
+Thread(target=xp_flush_loop, daemon=True).start()
+
+SHUTDOWN_TIMEOUT = 25  # seconds; under gunicorn's 30 s graceful timeout
+
+
+@atexit.register
+def drain_writes():
+    """Write pending XP and wait for queued writes before the process exits"""
+    # The writer and XP flusher are daemon threads, so without this a restart
+    # would lose writes the users were already told about
+    flush_xp()
+    with cache_lock:
+        versions = dict(write_versions)
+    if not wait_for_writes(versions, SHUTDOWN_TIMEOUT):
+        print("Shutting down with sheet writes still queued")
 
 
 def get_user_total_xp(userid):
-    """Get user's total XP from xp sheet"""
+    """Get user's total XP from xp sheet, including XP not flushed yet"""
     try:
-        records = xp_sheet.get_all_records()
-        for row in records:
-            if str(row['UserID']) == str(userid):
-                return int(row.get('TotalXP', 0))
-        return 0
+        user_rows = rows_for(xp_sheet, userid)  # may fetch, so outside xp_lock
+        userid = str(userid)
+        with xp_lock:
+            _, pending = pending_xp.get(userid, (None, 0))
+            _, flushing = flushing_xp.get(userid, (None, 0))
+            # Re-read the (already loaded) cache: a flush may have written
+            # this user's row since the lookup above
+            entry = sheet_cache.get(xp_sheet.id)
+            if entry:
+                user_rows = entry.index.get(userid, [])
+            for _, row in user_rows:
+                return row.get('TotalXP', 0) + pending + flushing
+            return pending + flushing
     except:
         return 0
 
@@ -76,66 +525,60 @@ def get_user_total_xp(userid):
 def calculate_streak(userid):
     """Calculate daily streak from attendance sheet"""
     try:
-        records = attendance_sheet.get_all_records()
-        dates = set()
-        for row in records:
-            if str(row['UserID']) == str(userid):
-                try:
-                    date = datetime.strptime(str(row['Date']), "%Y-%m-%d %H:%M:%S").date()
-                    dates.add(date)
-                except ValueError:
-                    pass
-
-        if not dates:
-            return 0
+        days = {row['_day'].toordinal() for _, row in rows_for(attendance_sheet, userid) if row['_day']}
 
+        # Walk back from today one ordinal at a time (capped at a year)
+        today = datetime.now().date().toordinal()
         streak = 0
-        today = datetime.now().date()
-
-        for i in range(0, 365):
-            day = today - timedelta(days=i)
-            if day in dates:
-                streak += 1
-            else:
-                break
+        while streak < 365 and today - streak in days:
+            streak += 1
         return streak
     except:
         return 0
 
 
+def top_users(records):
+    """Top 5 (username, TotalXP) pairs of all time"""
+    # TotalXP is always an int after _normalize, so the key can be a C-level getter
+    top = heapq.nlargest(5, records, key=itemgetter('TotalXP'))
+    return [(user['Username'], user['TotalXP']) for user in top]
+
+
+def weekly_top_users(records):
+    """Top 5 (username, TotalXP) pairs among users active in the last 7 days"""
+    one_week_ago = datetime.now() - timedelta(days=7)
+
+    weekly_xp = {}
+    for user in records:
+        if user.get('_updated') and user['_updated'] >= one_week_ago:
+            weekly_xp[user['Username']] = user.get('TotalXP', 0)
+
+    return heapq.nlargest(5, weekly_xp.items(), key=itemgetter(1))
+
+
 # === Rank System ===
+RANK_THRESHOLDS = (50, 150, 300, 500)
+RANK_NAMES = ("🍼 Newbie", "📕 Beginner", "📙 Intermediate", "📗 Master", "📘 Scholar")
+
+
 def get_rank(xp):
-    xp = int(xp)
-    if xp >= 500:
-        return "📘 Scholar"
-    elif xp >= 300:
-        return "📗 Master"
-    elif xp >= 150:
-        return "📙 Intermediate"
-    elif xp >= 50:
-        return "📕 Beginner"
-    else:
-        return "🍼 Newbie"
+    return RANK_NAMES[bisect_right(RANK_THRESHOLDS, int(xp))]
 
 
 # === Badge System ===
+BADGE_THRESHOLDS = (50, 110, 150, 240)  # minutes
+BADGE_NAMES = ("🥉 Bronze Mind", "🥈 Silver Brain", "🥇 Golden Genius", "🔷 Diamond Crown")
+
+
 def get_badges(total_minutes):
-    badges = []
-    if total_minutes >= 50:
-        badges.append("🥉 Bronze Mind")
-    if total_minutes >= 110:
-        badges.append("🥈 Silver Brain")
-    if total_minutes >= 150:
-        badges.append("🥇 Golden Genius")
-    if total_minutes >= 240:
-        badges.append("🔷 Diamond Crown")
-    return badges
+    return list(BADGE_NAMES[:bisect_right(BADGE_THRESHOLDS, total_minutes)])
 
 
 # === ROUTES ===
 
 # ✅ !attend
 @app.route("/attend")
+@with_sheet_lock(attendance_sheet)
 def attend():
     username = request.args.get('user') or ""
     userid = request.args.get('id') or ""
@@ -144,21 +587,17 @@ def attend():
 
     # Check if this user already gave attendance today
     try:
-        records = attendance_sheet.get_all_records()
-        for row in records[::-1]:
-            if str(row['UserID']) == str(userid):
-                try:
-                    row_date = datetime.strptime(str(row['Date']), "%Y-%m-%d %H:%M:%S").date()
-                    if row_date == today_date:
-                        return f"⚠️ {username}, your attendance for today is already recorded! ✅"
-                except ValueError:
-                    continue
+        for _, row in reversed(rows_for(attendance_sheet, userid)):
+            if row['_day'] == today_date:
+                return f"⚠️ {username}, your attendance for today is already recorded! ✅"
+            if row['_day'] and row['_day'] < today_date:
+                break  # rows are appended in date order, so today can't be further back
     except:
         pass
 
     # Log new attendance
     timestamp = now.strftime("%Y-%m-%d %H:%M:%S")
-    attendance_sheet.append_row([username, userid, timestamp])
+    append_row(attendance_sheet, [username, userid, timestamp])
     
     # Update XP
     update_user_xp(username, userid, 10, "Attendance")
@@ -168,48 +607,43 @@ def attend():
 
 
 @app.route("/start")
+@with_sheet_lock(session_sheet)
 def start():
     username = request.args.get('user')
     userid = request.args.get('id')
     now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
     try:
-        records = session_sheet.get_all_records()
         # Check if a session is already running (not marked as completed)
-        for row in reversed(records):
-            if str(row.get('UserID', '')) == str(userid) and str(row.get('Status', '')).strip() == 'Active':
-                return f"⚠️ {username}, you already started a session. Use `!stop` before starting a new one."
+        if latest_row(session_sheet, userid, 'Active'):
+            return f"⚠️ {username}, you already started a session. Use `!stop` before starting a new one."
     except Exception as e:
         print(f"Error checking sessions: {e}")
 
     # Log new session start
-    session_sheet.append_row([username, userid, now, "", "", "Active"])
+    append_row(session_sheet, [username, userid, now, "", "", "Active"])
     return f"⏱️ {username}, your study session has started! Use `!stop` to end it. Happy studying 📚"
 
 
 # ✅ !stop
 @app.route("/stop")
+@with_sheet_lock(session_sheet)
 def stop():
     username = request.args.get('user')
     userid = request.args.get('id')
     now = datetime.now()
 
     try:
-        records = session_sheet.get_all_records()
-        
         # Find the latest active session
         session_start = None
         row_index = None
-        for i in range(len(records) - 1, -1, -1):
-            row = records[i]
-            if (str(row.get('UserID', '')) == str(userid) and str(row.get('Status', '')).strip() == 'Active'):
-                try:
-                    session_start = datetime.strptime(row.get('StartTime', ''), "%Y-%m-%d %H:%M:%S")
-                    row_index = i + 2
+        for row_number, row in reversed(rows_for(session_sheet, userid)):
+            if row.get('Status') == 'Active':
+                if row['_start']:
+                    session_start = row['_start']
+                    row_index = row_number
                     break
-                except (ValueError, TypeError):
-                    print(f"Error parsing start time: {row.get('StartTime', '')}")
-                    continue
+                print(f"Error parsing start time: {row.get('StartTime', '')}")
 
         if not session_start:
             return f"⚠️ {username}, you didn't start any session. Use `!start` to begin."
@@ -219,9 +653,11 @@ def stop():
         xp_earned = duration_minutes * 2
 
         # Update the session record
-        session_sheet.update_cell(row_index, 4, now.strftime("%Y-%m-%d %H:%M:%S"))  # EndTime
-        session_sheet.update_cell(row_index, 5, duration_minutes)  # Duration
-        session_sheet.update_cell(row_index, 6, "Completed")  # Status
+        update_cells(session_sheet, row_index, {
+            4: now.strftime("%Y-%m-%d %H:%M:%S"),  # EndTime
+            5: duration_minutes,  # Duration
+            6: "Completed"  # Status
+        })
 
         # Update XP
         update_user_xp(username, userid, xp_earned, "Study Session")
@@ -251,20 +687,19 @@ def rank():
 @app.route("/top")
 def leaderboard():
     try:
-        records = xp_sheet.get_all_records()
-        sorted_users = sorted(records, key=lambda x: int(x.get('TotalXP', 0)), reverse=True)[:5]
-        
-        message = "🏆 Top 5 Learners:\n"
-        for i, user in enumerate(sorted_users, 1):
-            message += f"{i}. {user['Username']} - {user.get('TotalXP', 0)} XP\n"
+        flush_xp()  # rank on up-to-date totals
+        # Recomputed only when the xp sheet changes, not on every call
+        sorted_users = derived(xp_sheet, "top", top_users)
 
-        return message.strip()
+        lines = ["🏆 Top 5 Learners:"] + [f"{i}. {user} - {xp} XP" for i, (user, xp) in enumerate(sorted_users, 1)]
+        return "\n".join(lines)
     except:
         return "⚠️ Unable to fetch leaderboard data."
 
 
 # ✅ !task
 @app.route("/task")
+@with_sheet_lock(task_sheet)
 def add_task():
     username = request.args.get('user')
     userid = request.args.get('id')
@@ -274,66 +709,63 @@ def add_task():
         return f"⚠️ {username}, please provide a task like: !task Physics Chapter 1 or !task Studying Math."
 
     try:
-        records = task_sheet.get_all_records()
-        for row in records[::-1]:
-            if str(row.get('UserID', '')) == str(userid) and str(row.get('Status', '')).strip() == 'Pending':
-                return f"⚠️ {username}, please complete your previous task first. Use `!done` to mark it as completed."
+        if latest_row(task_sheet, userid, 'Pending'):
+            return f"⚠️ {username}, please complete your previous task first. Use `!done` to mark it as completed."
     except Exception as e:
         print(f"Error checking tasks: {e}")
 
     now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     task_name = msg.strip()
-    task_sheet.append_row([username, userid, task_name, now, "", "Pending"])
+    append_row(task_sheet, [username, userid, task_name, now, "", "Pending"])
     return f"✏️ {username}, your task '{task_name}' has been added. Study well! Use `!done` to mark it as completed. Use `!remove` to remove it."
 
 
 # ✅ !done
 @app.route("/done")
+@with_sheet_lock(task_sheet)
 def mark_done():
     username = request.args.get('user')
     userid = request.args.get('id')
 
     try:
-        records = task_sheet.get_all_records()
+        found = latest_row(task_sheet, userid, 'Pending')
+        if not found:
+            return f"⚠️ {username}, you don't have any active task. Use `!task Your Task` to add one."
 
-        for i in range(len(records) - 1, -1, -1):
-            row = records[i]
-            if str(row.get('UserID', '')) == str(userid) and str(row.get('Status', '')).strip() == 'Pending':
-                row_index = i + 2
-                task_name = row.get('TaskName', '')
+        row_index, row = found
+        task_name = row.get('TaskName', '')
 
-                # Mark task as completed
-                task_sheet.update_cell(row_index, 5, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))  # CompletedDate
-                task_sheet.update_cell(row_index, 6, "Completed")  # Status
+        # Mark task as completed
+        update_cells(task_sheet, row_index, {
+            5: datetime.now().strftime("%Y-%m-%d %H:%M:%S"),  # CompletedDate
+            6: "Completed"  # Status
+        })
 
-                # Update XP
-                xp_earned = 15
-                update_user_xp(username, userid, xp_earned, "Task Completed")
-
-                return f"✅ {username}, you completed your task '{task_name}' and earned {xp_earned} XP! Great job! 💪"
+        # Update XP
+        xp_earned = 15
+        update_user_xp(username, userid, xp_earned, "Task Completed")
 
-        return f"⚠️ {username}, you don't have any active task. Use `!task Your Task` to add one."
+        return f"✅ {username}, you completed your task '{task_name}' and earned {xp_earned} XP! Great job! 💪"
     except Exception as e:
         return f"⚠️ Error completing task: {str(e)}"
 
 
 # ✅ !remove
 @app.route("/remove")
+@with_sheet_lock(task_sheet)
 def remove_task():
     username = request.args.get('user')
     userid = request.args.get('id')
 
     try:
-        records = task_sheet.get_all_records()
-        for i in range(len(records) - 1, -1, -1):
-            row = records[i]
-            if str(row.get('UserID', '')) == str(userid) and str(row.get('Status', '')).strip() == 'Pending':
-                row_index = i + 2
-                task_name = row.get('TaskName', '')
-                task_sheet.delete_rows(row_index)
-                return f"🗑️ {username}, your task '{task_name}' has been removed. Use `!task Your Task` to add a new one."
-
-        return f"⚠️ {username}, you have no active task to remove. Use `!task Your Task` to add one."
+        found = latest_row(task_sheet, userid, 'Pending')
+        if not found:
+            return f"⚠️ {username}, you have no active task to remove. Use `!task Your Task` to add one."
+
+        row_index, row = found
+        task_name = row.get('TaskName', '')
+        delete_rows(task_sheet, row_index)
+        return f"🗑️ {username}, your task '{task_name}' has been removed. Use `!task Your Task` to add a new one."
     except Exception as e:
         return f"⚠️ Error removing task: {str(e)}"
 
@@ -342,24 +774,11 @@ def remove_task():
 @app.route("/weeklytop")
 def weekly_top():
     try:
-        records = xp_sheet.get_all_records()
-        one_week_ago = datetime.now() - timedelta(days=7)
-        
-        weekly_xp = {}
-        for user in records:
-            try:
-                last_updated = datetime.strptime(user['LastUpdated'], "%Y-%m-%d %H:%M:%S")
-                if last_updated >= one_week_ago:
-                    weekly_xp[user['Username']] = int(user.get('TotalXP', 0))
-            except:
-                continue
-
-        sorted_users = sorted(weekly_xp.items(), key=lambda x: x[1], reverse=True)[:5]
-        message = "📆 Weekly Top 5 Learners:\n"
-        for i, (user, xp) in enumerate(sorted_users, 1):
-            message += f"{i}. {user} - {xp} XP\n"
-
-        return message.strip()
+        flush_xp()  # rank on up-to-date totals
+        # Recomputed only when the xp sheet changes (or is refetched after CACHE_TTL)
+        sorted_users = derived(xp_sheet, "weeklytop", weekly_top_users)
+        lines = ["📆 Weekly Top 5 Learners:"] + [f"{i}. {user} - {xp} XP" for i, (user, xp) in enumerate(sorted_users, 1)]
+        return "\n".join(lines)
     except:
         return "⚠️ Unable to fetch weekly leaderboard data."
 
@@ -375,25 +794,15 @@ def summary():
         total_xp = get_user_total_xp(userid)
         
         # Get total study time from sessions
-        session_records = session_sheet.get_all_records()
         total_minutes = 0
-        for row in session_records:
-            if str(row['UserID']) == str(userid) and row['Status'] == 'Completed':
-                try:
-                    total_minutes += int(row['Duration'])
-                except ValueError:
-                    pass
+        for _, row in rows_for(session_sheet, userid):
+            if row['Status'] == 'Completed':
+                total_minutes += row['Duration']
 
         # Get task counts
-        task_records = task_sheet.get_all_records()
-        completed_tasks = 0
-        pending_tasks = 0
-        for row in task_records:
-            if str(row['UserID']) == str(userid):
-                if row['Status'] == 'Completed':
-                    completed_tasks += 1
-                elif row['Status'] == 'Pending':
-                    pending_tasks += 1
+        task_counts = Counter(row['Status'] for _, row in rows_for(task_sheet, userid))
+        completed_tasks = task_counts['Completed']
+        pending_tasks = task_counts['Pending']
 
         
         hours = total_minutes // 60
@@ -414,13 +823,12 @@ def pending_task():
     userid = request.args.get('id')
 
     try:
-        records = task_sheet.get_all_records()
-        for row in reversed(records):
-            if str(row.get('UserID', '')) == str(userid) and str(row.get('Status', '')).strip() == 'Pending':
-                task_name = row.get('TaskName', '')
-                return f"🕒 {username}, your current pending task is: '{task_name}' — Keep going. Use `!done` to mark it as completed. Use `!remove` to remove it."
+        found = latest_row(task_sheet, userid, 'Pending')
+        if not found:
+            return f"✅ {username}, you have no pending tasks! Use `!task Your Task` to add one."
 
-        return f"✅ {username}, you have no pending tasks! Use `!task Your Task` to add one."
+        task_name = found[1].get('TaskName', '')
+        return f"🕒 {username}, your current pending task is: '{task_name}' — Keep going. Use `!done` to mark it as completed. Use `!remove` to remove it."
     except Exception as e:
         return f"⚠️ Error fetching pending tasks: {str(e)}"
 
@@ -432,11 +840,10 @@ def completed_tasks():
     userid = request.args.get('id')
 
     try:
-        records = task_sheet.get_all_records()
         completed = []
 
-        for row in reversed(records):
-            if str(row.get('UserID', '')) == str(userid) and str(row.get('Status', '')).strip() == 'Completed':
+        for _, row in reversed(rows_for(task_sheet, userid)):
+            if row.get('Status') == 'Completed':
                 completed.append(row.get('TaskName', ''))
                 if len(completed) == 3:
                     break
@@ -452,6 +859,7 @@ def completed_tasks():
 
 # ✅ !goal - NEW GOAL FUNCTIONALITY
 @app.route("/goal")
+@with_sheet_lock(goal_sheet)
 def goal():
     username = request.args.get('user')
     userid = request.args.get('id')
@@ -461,53 +869,52 @@ def goal():
         return f"⚠️ {username}, please provide a goal like: !goal Complete Math Course or !goal Read 5 Books."
 
     try:
-        records = goal_sheet.get_all_records()
         # Check if user already has an active goal
-        for row in records[::-1]:
-            if str(row.get('UserID', '')) == str(userid) and str(row.get('Status', '')).strip() == 'Pending':
-                return f"⚠️ {username}, please complete your previous goal first. Use `!complete` to mark it as completed."
+        if latest_row(goal_sheet, userid, 'Pending'):
+            return f"⚠️ {username}, please complete your previous goal first. Use `!complete` to mark it as completed."
     except Exception as e:
         print(f"Error checking goals: {e}")
 
     now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     goal_name = msg.strip()
-    goal_sheet.append_row([username, userid, goal_name, now, "", "Pending"])
+    append_row(goal_sheet, [username, userid, goal_name, now, "", "Pending"])
     return f"🎯 {username}, your goal '{goal_name}' has been set! Work towards it and use `!complete` when you achieve it. You'll earn 25 XP! 💪"
 
 
 # ✅ !complete - COMPLETE GOAL FUNCTIONALITY
 @app.route("/complete")
+@with_sheet_lock(goal_sheet)
 def complete_goal():
     username = request.args.get('user')
     userid = request.args.get('id')
 
     try:
-        records = goal_sheet.get_all_records()
-
-        for i in range(len(records) - 1, -1, -1):
-            row = records[i]
-            if str(row.get('UserID', '')) == str(userid) and str(row.get('Status', '')).strip() == 'Pending':
-                row_index = i + 2
-                goal_name = row.get('GoalName', '')
+        found = latest_row(goal_sheet, userid, 'Pending')
+        if not found:
+            return f"⚠️ {username}, you don't have any active goal. Use `!goal Your Goal` to set one."
 
-                # Mark goal as completed
-                goal_sheet.update_cell(row_index, 5, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))  # CompletedDate
-                goal_sheet.update_cell(row_index, 6, "Completed")  # Status
+        row_index, row = found
+        goal_name = row.get('GoalName', '')
 
-                # Update XP - Goals give 25 XP
-                xp_earned = 25
-                update_user_xp(username, userid, xp_earned, "Goal Completed")
+        # Mark goal as completed
+        update_cells(goal_sheet, row_index, {
+            5: datetime.now().strftime("%Y-%m-%d %H:%M:%S"),  # CompletedDate
+            6: "Completed"  # Status
+        })
 
-                return f"🎉 {username}, congratulations! You completed your goal '{goal_name}' and earned {xp_earned} XP! Amazing achievement! 🏆✨"
+        # Update XP - Goals give 25 XP
+        xp_earned = 25
+        update_user_xp(username, userid, xp_earned, "Goal Completed")
 
-        return f"⚠️ {username}, you don't have any active goal. Use `!goal Your Goal` to set one."
+        return f"🎉 {username}, congratulations! You completed your goal '{goal_name}' and earned {xp_earned} XP! Amazing achievement! 🏆✨"
     except Exception as e:
         return f"⚠️ Error completing goal: {str(e)}"
 
 
-@app.route("/ping")
+# Uptime checks hit this often: it must stay free of sheet, cache or lock access
+@app.route("/ping", methods=["GET"])
 def ping():
-    return "🟢 Sunnie-BOT is alive!"
+    return "🟢 Sunnie-BOT is alive!", 200, {"Cache-Control": "no-store", "Content-Type": "text/plain; charset=utf-8"}
 
 
 # === Run Server ===
@@ -0,0 +1,15 @@
+"""Create the worksheets Sunnie-BOT adds on its own if they are missing.
+
+The app also creates them on first use; run `python bootstrap.py` to do it
+ahead of the first request.
+"""
+from sheets import SHEET_HEADERS, get_worksheet
+
+
+def main():
+    for title in SHEET_HEADERS:
+        get_worksheet(title)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+from functools import lru_cache
+import random
+import time
+from threading import Lock
+import gspread
+from requests.adapters import HTTPAdapter
+
+# === Google Sheet Setup ===
+# Nothing here talks to Google until first use, so the app starts without
+# paying for the auth + open + worksheet lookups up front.
+SERVICE_ACCOUNT_FILE = "/etc/secrets/credentials.json"
+SPREADSHEET_NAME = "StudyPlusData"
+RETRY_ATTEMPTS = 5
+RETRY_STATUSES = {429}
+RETRY_SERVER_STATUSES = {429, 500, 502, 503, 504}
+
+# Sheets the bot creates itself if missing; attendance, session, task and xp must exist already
+SHEET_HEADERS = {
+    "goal": ["Username", "UserID", "GoalName", "CreatedDate", "CompletedDate", "Status"],
+}
+
+
+@lru_cache(maxsize=None)
+def get_client():
+    """Return the shared gspread client"""
+    client = gspread.service_account(filename=SERVICE_ACCOUNT_FILE)
+    # Request threads and the writer thread share this client; a bigger pool keeps
+    # their HTTPS connections alive instead of re-handshaking on every call
+    client.session.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=32))
+    return client
+
+
+@lru_cache(maxsize=None)
+def get_spreadsheet():
+    """Open the StudyPlusData spreadsheet once"""
+    return get_client().open(SPREADSHEET_NAME)
+
+
+# lru_cache doesn't stop two threads from missing at once, and only one of
+# them may create a sheet
+create_lock = Lock()
+
+
+@lru_cache(maxsize=None)
+def get_worksheet(name):
+    """Look a worksheet up once by title, creating it if it's one the bot owns"""
+    try:
+        return get_spreadsheet().worksheet(name)
+    except gspread.exceptions.WorksheetNotFound:
+        if name not in SHEET_HEADERS:
+            raise
+    with create_lock:
+        # Another thread may have created it while this one waited
+        try:
+            return get_spreadsheet().worksheet(name)
+        except gspread.exceptions.WorksheetNotFound:
+            pass
+        headers = SHEET_HEADERS[name]
+        sheet = get_spreadsheet().add_worksheet(title=name, rows="1000", cols=str(len(headers)))
+        sheet.append_row(headers)
+        print(f"Created '{name}' sheet")
+        return sheet
+
+
+class LazyWorksheet:
+    """Stands in for a worksheet and opens it on first use"""
+
+    def __init__(self, title):
+        self.title = title
+
+    def __getattr__(self, name):
+        return getattr(get_worksheet(self.title), name)
+
+
+def with_backoff(call, retry_server_errors=True):
+    """Run a Sheets API call, retrying with exponential backoff while it is rate
+    limited or Google reports a transient server error"""
+    # A 429 is rejected before anything is applied, so it's always safe to
+    # resend. A 5xx usually wasn't applied either; callers whose resend would
+    # do damage if it was (row deletions) pass retry_server_errors=False
+    retry = RETRY_SERVER_STATUSES if retry_server_errors else RETRY_STATUSES
+    for attempt in range(RETRY_ATTEMPTS):
+        try:
+            return call()
+        except gspread.exceptions.APIError as e:
+            if e.response.status_code not in retry or attempt == RETRY_ATTEMPTS - 1:
+                raise
+            time.sleep(2 ** attempt + random.random())